@@ -1,12 +1,19 @@
+import asyncio
+import functools
 import logging
 import os
+import re
+import sqlite3
+import tempfile
+from collections import deque
 from datetime import datetime
 from decimal import Decimal, InvalidOperation
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Union
 
 import openpyxl
-from openpyxl.styles import Alignment, Font, PatternFill
+import xlsxwriter
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -30,8 +37,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+DB_PATH = Path("case_battle_ledger.db")
 EXCEL_PATH = Path("case_battle_ledger.xlsx")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+PORT = int(os.getenv("PORT", "8443"))
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 MENU_KEYBOARD = ReplyKeyboardMarkup(
     [
@@ -43,144 +54,380 @@ MENU_KEYBOARD = ReplyKeyboardMarkup(
     resize_keyboard=True,
 )
 
+HEADER_FORMAT = {"bold": True, "bg_color": "#4472C4", "font_color": "white", "align": "center"}
+
+TX_META = {
+    "deposit": ("Пополнение", "💰"),
+    "withdraw": ("Вывод", "💸"),
+}
+
+TX_OK_TEMPLATE = "✅ {title}: <code>{amount:,.2f}</code> ₽\n💼 Баланс: <code>{balance:,.2f}</code> ₽"
+BALANCE_TEMPLATE = "💼 Баланс: <code>{balance:,.2f}</code> ₽\n📈 ROI: <code>{roi:,.2f}%</code>"
+STATS_TEMPLATE = (
+    "📊 <b>Статистика</b>\n\n"
+    "💰 Ввод: <code>{deposits:,.2f}</code> ₽\n"
+    "💸 Вывод: <code>{withdrawals:,.2f}</code> ₽\n"
+    "💼 Итого (баланс): <code>{balance:,.2f}</code> ₽\n"
+    "📈 ROI: <code>{roi:,.2f}%</code>\n"
+    "{pnl_label}: <code>{pnl:,.2f}</code> ₽"
+)
+HISTORY_HEADER = "📝 <b>Последние операции:</b>"
+HISTORY_LINE_TEMPLATE = "{emoji} {title}: <code>{amount:,.2f}</code> ₽ — {timestamp}"
+
+
+def to_kopecks(amount: Decimal) -> int:
+    return int((amount * 100).to_integral_value())
+
+
+def from_kopecks(kopecks: int) -> Decimal:
+    return Decimal(kopecks).scaleb(-2)
+
 
 class LedgerStorage:
-    """Хранилище транзакций в Excel (единый источник данных)."""
+    """Хранилище транзакций в SQLite; Excel формируется только для выгрузки."""
 
     TX_HEADERS = ["user_id", "type", "amount", "timestamp"]
+    SUMMARY_HEADERS = ["user_id", "deposits", "withdrawals", "balance", "roi_percent", "updated_at"]
+    TX_WIDTHS = (14, 12, 14, 20)
+    SUMMARY_WIDTHS = (14, 14, 14, 14, 13, 20)
+    HISTORY_WINDOW = 50
+    WRITE_BATCH_MAX = 500
+    # Версии базы (PRAGMA user_version):
+    # 1 — суммы хранятся целыми копейками вместо REAL-рублей;
+    # 2 — перенос старой Excel-базы завершен или не требовался.
+    KOPECKS_VERSION = 1
+    LEGACY_IMPORTED_VERSION = 2
+    TX_TABLE_SQL = (
+        "CREATE TABLE IF NOT EXISTS transactions ("
+        "user_id INTEGER NOT NULL, type TEXT NOT NULL, amount INTEGER NOT NULL, ts TEXT NOT NULL)"
+    )
 
-    def __init__(self, file_path: Path):
-        self.file_path = file_path
-        self._init_workbook()
+    def __init__(self, db_path: Path, legacy_excel_path: Optional[Path] = None):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._init_schema()
+        if self._user_version() < self.LEGACY_IMPORTED_VERSION:
+            self._import_legacy_excel(legacy_excel_path)
+        self._stats: Dict[int, Tuple[int, int]] = {}
+        self._load_stats()
+        self._recent: Dict[int, Deque[Tuple[str, int, str]]] = {}
+        self._load_recent()
+        self._lock = asyncio.Lock()
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def _user_version(self) -> int:
+        return self._conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def _init_schema(self) -> None:
+        version = self._user_version()
+        with self._conn:
+            self._conn.execute("BEGIN")
+            if version < self.KOPECKS_VERSION and self._has_table("transactions"):
+                self._migrate_amounts_to_kopecks()
+            self._conn.execute(self.TX_TABLE_SQL)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id)")
+            if version < self.KOPECKS_VERSION:
+                self._conn.execute(f"PRAGMA user_version = {self.KOPECKS_VERSION}")
+
+    def _has_table(self, name: str) -> bool:
+        row = self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+        return row is not None
+
+    def _migrate_amounts_to_kopecks(self) -> None:
+        self._conn.execute("ALTER TABLE transactions RENAME TO transactions_v0")
+        self._conn.execute(self.TX_TABLE_SQL)
+        self._conn.execute(
+            "INSERT INTO transactions (rowid, user_id, type, amount, ts) "
+            "SELECT rowid, user_id, type, CAST(ROUND(amount * 100) AS INTEGER), ts FROM transactions_v0"
+        )
+        self._conn.execute("DROP TABLE transactions_v0")
 
-    def _init_workbook(self) -> None:
-        if self.file_path.exists():
-            return
+    def _import_legacy_excel(self, excel_path: Optional[Path]) -> None:
+        """Однократный перенос данных из старой Excel-базы в SQLite.
 
-        wb = openpyxl.Workbook()
-        tx_sheet = wb.active
-        tx_sheet.title = "Transactions"
-        tx_sheet.append(self.TX_HEADERS)
-
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-        header_font = Font(color="FFFFFF", bold=True)
-        for col, header in enumerate(self.TX_HEADERS, 1):
-            cell = tx_sheet.cell(row=1, column=col, value=header)
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center")
-
-        summary = wb.create_sheet("Summary")
-        summary.append(["user_id", "deposits", "withdrawals", "balance", "roi_percent", "updated_at"])
-        for col in range(1, 7):
-            cell = summary.cell(row=1, column=col)
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal="center")
-
-        wb.save(self.file_path)
-
-    def _load_wb(self):
-        return openpyxl.load_workbook(self.file_path)
-
-    def _save_wb(self, wb) -> None:
-        self._autosize_columns(wb["Transactions"])
-        self._autosize_columns(wb["Summary"])
-        wb.save(self.file_path)
+        Отметка о переносе пишется в той же транзакции, что и строки: если чтение файла
+        упадет, при следующем запуске перенос будет повторен, а не пропущен.
+        """
+        rows = []
+        has_rows = self._conn.execute("SELECT 1 FROM transactions LIMIT 1").fetchone() is not None
+        if excel_path is not None and excel_path.exists() and not has_rows:
+            rows = self._read_legacy_rows(excel_path)
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT INTO transactions (user_id, type, amount, ts) VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute(f"PRAGMA user_version = {self.LEGACY_IMPORTED_VERSION}")
+        if rows:
+            logger.info("Imported %d transactions from %s", len(rows), excel_path)
+
+    def _read_legacy_rows(self, excel_path: Path) -> List[Tuple[int, str, int, str]]:
+        wb = self._load_wb_ro(excel_path)
+        try:
+            if "Transactions" not in wb.sheetnames:
+                return []
+            return [
+                (int(row[0]), row[1], to_kopecks(Decimal(str(row[2]))), str(row[3]))
+                for row in wb["Transactions"].iter_rows(min_row=2, values_only=True)
+                if row[0]
+            ]
+        finally:
+            wb.close()
+
+    def _load_stats(self) -> None:
+        """Один проход по транзакциям для прогрева кэша агрегатов."""
+        rows = self._conn.execute(
+            "SELECT user_id, "
+            "COALESCE(SUM(CASE WHEN type = 'deposit' THEN amount END), 0), "
+            "COALESCE(SUM(CASE WHEN type = 'withdraw' THEN amount END), 0) "
+            "FROM transactions GROUP BY user_id"
+        )
+        for uid, deposits, withdrawals in rows:
+            self._stats[uid] = (deposits, withdrawals)
+
+    def _load_recent(self) -> None:
+        """Последние HISTORY_WINDOW операций каждого пользователя для /history без запросов к БД."""
+        rows = self._conn.execute(
+            "SELECT user_id, type, amount, ts FROM ("
+            "SELECT rowid, user_id, type, amount, ts, "
+            "ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY rowid DESC) AS rn FROM transactions"
+            ") WHERE rn <= ? ORDER BY rowid",
+            (self.HISTORY_WINDOW,),
+        )
+        for uid, tx_type, amount, ts in rows:
+            self._recent.setdefault(uid, deque(maxlen=self.HISTORY_WINDOW)).append((tx_type, amount, ts))
 
     @staticmethod
-    def _autosize_columns(sheet) -> None:
-        for column in sheet.columns:
-            max_length = 0
-            for cell in column:
-                if cell.value is None:
-                    continue
-                max_length = max(max_length, len(str(cell.value)))
-            sheet.column_dimensions[column[0].column_letter].width = max_length + 2
-
-    def add_transaction(self, user_id: int, tx_type: str, amount: Decimal) -> None:
-        wb = self._load_wb()
-        tx = wb["Transactions"]
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        tx.append([user_id, tx_type, float(amount), timestamp])
-
-        self._rebuild_summary(wb)
-        self._save_wb(wb)
+    def _load_wb_ro(path: Path):
+        return openpyxl.load_workbook(path, read_only=True, data_only=True)
+
+    def add_transaction(self, user_id: int, tx_type: str, amount: Decimal) -> Decimal:
+        """Записывает операцию и возвращает новый баланс пользователя."""
+        return self.add_transactions([(user_id, tx_type, amount)])[0]
+
+    def add_transactions(self, items: List[Tuple[int, str, Decimal]]) -> List[Decimal]:
+        """Записывает пачку операций одной транзакцией SQLite и возвращает баланс после каждой."""
+        timestamp = datetime.now().strftime(TS_FORMAT)
+        rows = [(user_id, tx_type, to_kopecks(amount), timestamp) for user_id, tx_type, amount in items]
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT INTO transactions (user_id, type, amount, ts) VALUES (?, ?, ?, ?)", rows)
+
+        balances = []
+        for user_id, tx_type, kopecks, _ in rows:
+            deposits, withdrawals = self._stats.get(user_id, (0, 0))
+            if tx_type == "deposit":
+                deposits += kopecks
+            else:
+                withdrawals += kopecks
+            self._stats[user_id] = (deposits, withdrawals)
+            self._recent.setdefault(user_id, deque(maxlen=self.HISTORY_WINDOW)).append((tx_type, kopecks, timestamp))
+            balances.append(from_kopecks(deposits - withdrawals))
+        return balances
 
     def reset_user(self, user_id: int) -> None:
-        wb = self._load_wb()
-        tx = wb["Transactions"]
-        kept_rows = [self.TX_HEADERS]
+        self._conn.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
+        self._stats.pop(user_id, None)
+        self._recent.pop(user_id, None)
 
-        for row in tx.iter_rows(min_row=2, values_only=True):
-            if int(row[0]) != user_id:
-                kept_rows.append(list(row))
-
-        tx.delete_rows(1, tx.max_row)
-        for row in kept_rows:
-            tx.append(row)
-
-        self._rebuild_summary(wb)
-        self._save_wb(wb)
+    def get_user_stats(self, user_id: int) -> Tuple[Decimal, Decimal, Decimal, Decimal]:
+        deposits, withdrawals = self._stats.get(user_id, (0, 0))
+        return self._compute_stats(deposits, withdrawals)
 
-    def _rebuild_summary(self, wb) -> None:
-        tx_sheet = wb["Transactions"]
-        summary_sheet = wb["Summary"]
-        summary_sheet.delete_rows(2, summary_sheet.max_row)
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _compute_stats(deposits: int, withdrawals: int) -> Tuple[Decimal, Decimal, Decimal, Decimal]:
+        roi = (Decimal((withdrawals - deposits) * 100) / deposits) if deposits > 0 else Decimal("0")
+        return from_kopecks(deposits), from_kopecks(withdrawals), from_kopecks(deposits - withdrawals), round(roi, 2)
 
-        user_stats: Dict[int, Dict[str, Decimal]] = {}
-        for row in tx_sheet.iter_rows(min_row=2, values_only=True):
-            if not row[0]:
+    def get_user_history(self, user_id: int, limit: int = 10) -> List[Tuple[str, Decimal, str]]:
+        history = self._recent_history(user_id, limit)
+        if history is None:
+            history = self._query_history(user_id, limit)
+        return history
+
+    def _recent_history(self, user_id: int, limit: int) -> Optional[List[Tuple[str, Decimal, str]]]:
+        """История из памяти; None, если окна не хватает и нужен запрос к БД."""
+        recent = self._recent.get(user_id)
+        if recent is None:
+            return []
+        if len(recent) == self.HISTORY_WINDOW and limit > len(recent):
+            return None
+        return [(tx_type, from_kopecks(amount), ts) for tx_type, amount, ts in islice(reversed(recent), limit)]
+
+    def _query_history(self, user_id: int, limit: int) -> List[Tuple[str, Decimal, str]]:
+        rows = self._conn.execute(
+            "SELECT type, amount, ts FROM transactions WHERE user_id = ? ORDER BY rowid DESC LIMIT ?",
+            (user_id, limit),
+        ).fetchall()
+        return [(tx_type, from_kopecks(amount), ts) for tx_type, amount, ts in rows]
+
+    async def add_transaction_async(self, user_id: int, tx_type: str, amount: Decimal) -> Decimal:
+        if self._write_queue is None:
+            async with self._lock:
+                return await asyncio.to_thread(self.add_transaction, user_id, tx_type, amount)
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((user_id, tx_type, amount, future))
+        return await future
+
+    def start_writer(self) -> None:
+        """Запускает фоновую запись: операции, пришедшие одновременно, пишутся одной транзакцией."""
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer_loop(self._write_queue))
+
+    async def stop_writer(self) -> None:
+        if self._write_queue is None:
+            return
+        queue, self._write_queue = self._write_queue, None
+        queue.put_nowait(None)
+        await self._writer_task
+        self._writer_task = None
+
+    async def _writer_loop(self, queue: asyncio.Queue) -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            while len(batch) < self.WRITE_BATCH_MAX:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush_batch(batch)
+            if stopping:
+                return
+
+    async def _flush_batch(self, batch) -> None:
+        items = [item[:3] for item in batch]
+        async with self._lock:
+            try:
+                results = await asyncio.to_thread(self.add_transactions, items)
+            except Exception as exc:
+                if len(items) == 1:
+                    logger.exception("Failed to write transaction for user %s", items[0][0])
+                    results = [exc]
+                else:
+                    # Пачка откатилась целиком: пишем по одной, чтобы ошибку получил только ее автор.
+                    logger.warning("Batch of %d transactions failed, retrying one by one", len(items))
+                    results = await asyncio.to_thread(self._add_transactions_isolated, items)
+        for (*_, future), result in zip(batch, results):
+            if future.done():
                 continue
-            uid = int(row[0])
-            tx_type = row[1]
-            amount = Decimal(str(row[2]))
-
-            if uid not in user_stats:
-                user_stats[uid] = {"deposit": Decimal("0"), "withdraw": Decimal("0")}
-            user_stats[uid][tx_type] += amount
-
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        for uid, stats in sorted(user_stats.items()):
-            deposits = stats["deposit"]
-            withdrawals = stats["withdraw"]
-            balance = deposits - withdrawals
-            roi = ((withdrawals - deposits) / deposits * Decimal("100")) if deposits > 0 else Decimal("0")
-            summary_sheet.append([uid, float(deposits), float(withdrawals), float(balance), float(round(roi, 2)), now])
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _add_transactions_isolated(self, items: List[Tuple[int, str, Decimal]]) -> List[Union[Decimal, Exception]]:
+        results: List[Union[Decimal, Exception]] = []
+        for item in items:
+            try:
+                results.append(self.add_transactions([item])[0])
+            except Exception as exc:
+                logger.exception("Failed to write transaction for user %s", item[0])
+                results.append(exc)
+        return results
+
+    async def reset_user_async(self, user_id: int) -> None:
+        async with self._lock:
+            await asyncio.to_thread(self.reset_user, user_id)
+
+    async def get_user_stats_async(self, user_id: int) -> Tuple[Decimal, Decimal, Decimal, Decimal]:
+        # Агрегаты берутся из кэша в памяти, поток не нужен: лок лишь дожидается текущей записи.
+        async with self._lock:
+            return self.get_user_stats(user_id)
+
+    async def get_user_history_async(self, user_id: int, limit: int = 10) -> List[Tuple[str, Decimal, str]]:
+        async with self._lock:
+            history = self._recent_history(user_id, limit)
+            if history is None:
+                history = await asyncio.to_thread(self._query_history, user_id, limit)
+            return history
+
+    async def build_export_async(self, out_path: Path) -> None:
+        # Под локом только фиксируется снимок; сама сборка файла не блокирует остальные команды.
+        async with self._lock:
+            reader, stats = await asyncio.to_thread(self._open_export_snapshot)
+        try:
+            await asyncio.to_thread(self._write_export, out_path, reader, stats)
+        finally:
+            reader.close()
+
+    def build_export(self, out_path: Path) -> None:
+        reader, stats = self._open_export_snapshot()
+        try:
+            self._write_export(out_path, reader, stats)
+        finally:
+            reader.close()
+
+    def _open_export_snapshot(self) -> Tuple[sqlite3.Connection, Dict[int, Tuple[int, int]]]:
+        """Открывает read-only соединение с зафиксированным снимком WAL и копирует агрегаты того же момента."""
+        reader = sqlite3.connect(f"{self.db_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        reader.execute("BEGIN")
+        # Снимок в WAL берется при первом чтении, а не на BEGIN.
+        reader.execute("SELECT 1 FROM transactions LIMIT 1").fetchall()
+        return reader, dict(self._stats)
+
+    def _write_export(self, out_path: Path, reader: sqlite3.Connection, stats: Dict[int, Tuple[int, int]]) -> None:
+        workbook = xlsxwriter.Workbook(str(out_path), {"constant_memory": True, "use_zip64": True})
+        header_format = workbook.add_format(HEADER_FORMAT)
+        try:
+            tx_sheet = workbook.add_worksheet("Transactions")
+            self._write_header(tx_sheet, self.TX_HEADERS, self.TX_WIDTHS, header_format)
+            rows = reader.execute("SELECT user_id, type, amount / 100.0, ts FROM transactions ORDER BY rowid")
+            for i, row in enumerate(rows, 1):
+                tx_sheet.write_row(i, 0, row)
+
+            summary = workbook.add_worksheet("Summary")
+            self._write_header(summary, self.SUMMARY_HEADERS, self.SUMMARY_WIDTHS, header_format)
+            self._write_summary(summary, stats, datetime.now().strftime(TS_FORMAT))
+        finally:
+            workbook.close()
 
-    def get_user_stats(self, user_id: int) -> Tuple[Decimal, Decimal, Decimal, Decimal]:
-        wb = self._load_wb()
-        summary = wb["Summary"]
-
-        for row in summary.iter_rows(min_row=2, values_only=True):
-            if row[0] and int(row[0]) == user_id:
-                deposits = Decimal(str(row[1]))
-                withdrawals = Decimal(str(row[2]))
-                balance = Decimal(str(row[3]))
-                roi = Decimal(str(row[4]))
-                return deposits, withdrawals, balance, roi
-        return Decimal("0"), Decimal("0"), Decimal("0"), Decimal("0")
+    @staticmethod
+    def _write_header(sheet, headers: List[str], widths: Tuple[int, ...], header_format) -> None:
+        for col, width in enumerate(widths):
+            sheet.set_column(col, col, width)
+        sheet.write_row(0, 0, headers, header_format)
 
-    def get_user_history(self, user_id: int, limit: int = 10) -> List[Tuple[str, Decimal, str]]:
-        wb = self._load_wb()
-        tx = wb["Transactions"]
+    def _write_summary(self, summary_sheet, stats: Dict[int, Tuple[int, int]], now: str) -> None:
+        for i, (uid, (deposits, withdrawals)) in enumerate(sorted(stats.items()), 1):
+            roi = self._compute_stats(deposits, withdrawals)[3]
+            summary_sheet.write_row(i, 0, (uid, deposits / 100, withdrawals / 100, (deposits - withdrawals) / 100, float(roi), now))
 
-        rows = []
-        for row in tx.iter_rows(min_row=2, values_only=True):
-            if row[0] and int(row[0]) == user_id:
-                rows.append((row[1], Decimal(str(row[2])), str(row[3])))
-        return list(reversed(rows[-limit:]))
 
+ledger = LedgerStorage(DB_PATH, legacy_excel_path=EXCEL_PATH)
 
-ledger = LedgerStorage(EXCEL_PATH)
+
+AMOUNT_RE = re.compile(r"^\s*(\d{1,12})(?:[.,](\d{1,2}))?\s*$")
+# Верхняя граница та же, что и у AMOUNT_RE (12 цифр целой части): копейки должны влезать в INTEGER SQLite.
+MAX_AMOUNT = Decimal("1000000000000")
 
 
 def parse_amount(raw: str) -> Decimal:
+    match = AMOUNT_RE.match(raw)
+    if match:
+        integer, fraction = match.groups()
+        digits = integer + (fraction or "").ljust(2, "0")
+        if not digits.strip("0"):
+            raise ValueError("amount must be positive")
+        return Decimal((0, tuple(map(int, digits)), -2))
+
     normalized = raw.replace(",", ".").strip()
     value = Decimal(normalized)
     if value <= 0:
         raise ValueError("amount must be positive")
-    return value.quantize(Decimal("0.01"))
+    value = value.quantize(Decimal("0.01"))
+    if value >= MAX_AMOUNT:
+        raise ValueError("amount is too large")
+    return value
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -198,93 +445,83 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(msg, parse_mode="HTML", reply_markup=MENU_KEYBOARD)
 
 
-async def add_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not context.args:
-        await update.message.reply_text("❌ Укажи сумму: <code>/add 1000</code>", parse_mode="HTML")
-        return
-    try:
-        amount = parse_amount(context.args[0])
-    except (InvalidOperation, ValueError):
-        await update.message.reply_text("❌ Неверная сумма. Пример: <code>/add 1000</code>", parse_mode="HTML")
-        return
-
-    user_id = update.effective_user.id
-    ledger.add_transaction(user_id, "deposit", amount)
-    _, _, balance, _ = ledger.get_user_stats(user_id)
+async def _record_tx(update: Update, tx_type: str, amount: Decimal, reply_markup=None) -> None:
+    user_balance = await ledger.add_transaction_async(update.effective_user.id, tx_type, amount)
+    title, _ = TX_META[tx_type]
     await update.message.reply_text(
-        f"✅ Пополнение: <code>{amount:,.2f}</code> ₽\n💼 Баланс: <code>{balance:,.2f}</code> ₽",
+        TX_OK_TEMPLATE.format_map({"title": title, "amount": amount, "balance": user_balance}),
         parse_mode="HTML",
+        reply_markup=reply_markup,
     )
 
 
-async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _tx_command(update: Update, context: ContextTypes.DEFAULT_TYPE, tx_type: str, usage: str) -> None:
     if not context.args:
-        await update.message.reply_text("❌ Укажи сумму: <code>/withdraw 500</code>", parse_mode="HTML")
+        await update.message.reply_text(f"❌ Укажи сумму: <code>{usage}</code>", parse_mode="HTML")
         return
     try:
         amount = parse_amount(context.args[0])
     except (InvalidOperation, ValueError):
-        await update.message.reply_text("❌ Неверная сумма. Пример: <code>/withdraw 500</code>", parse_mode="HTML")
+        await update.message.reply_text(f"❌ Неверная сумма. Пример: <code>{usage}</code>", parse_mode="HTML")
         return
+    await _record_tx(update, tx_type, amount)
 
-    user_id = update.effective_user.id
-    ledger.add_transaction(user_id, "withdraw", amount)
-    _, _, balance, _ = ledger.get_user_stats(user_id)
-    await update.message.reply_text(
-        f"✅ Вывод: <code>{amount:,.2f}</code> ₽\n💼 Баланс: <code>{balance:,.2f}</code> ₽",
-        parse_mode="HTML",
-    )
+
+add_deposit = functools.partial(_tx_command, tx_type="deposit", usage="/add 1000")
+withdraw = functools.partial(_tx_command, tx_type="withdraw", usage="/withdraw 500")
 
 
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    _, _, user_balance, roi = ledger.get_user_stats(user_id)
+    _, _, user_balance, roi = await ledger.get_user_stats_async(user_id)
     await update.message.reply_text(
-        f"💼 Баланс: <code>{user_balance:,.2f}</code> ₽\n📈 ROI: <code>{roi:,.2f}%</code>",
+        BALANCE_TEMPLATE.format_map({"balance": user_balance, "roi": roi}),
         parse_mode="HTML",
     )
 
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    deposits, withdrawals, user_balance, roi = ledger.get_user_stats(user_id)
+    deposits, withdrawals, user_balance, roi = await ledger.get_user_stats_async(user_id)
     pnl = withdrawals - deposits
+    ctx = {
+        "deposits": deposits,
+        "withdrawals": withdrawals,
+        "balance": user_balance,
+        "roi": roi,
+        "pnl_label": "🎉 Прибыль" if pnl >= 0 else "💔 Убыток",
+        "pnl": abs(pnl),
+    }
     await update.message.reply_text(
-        "📊 <b>Статистика</b>\n\n"
-        f"💰 Ввод: <code>{deposits:,.2f}</code> ₽\n"
-        f"💸 Вывод: <code>{withdrawals:,.2f}</code> ₽\n"
-        f"💼 Итого (баланс): <code>{user_balance:,.2f}</code> ₽\n"
-        f"📈 ROI: <code>{roi:,.2f}%</code>\n"
-        f"{'🎉 Прибыль' if pnl >= 0 else '💔 Убыток'}: <code>{abs(pnl):,.2f}</code> ₽",
+        STATS_TEMPLATE.format_map(ctx),
         parse_mode="HTML",
     )
 
 
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    history_rows = ledger.get_user_history(user_id)
+    history_rows = await ledger.get_user_history_async(user_id)
     if not history_rows:
         await update.message.reply_text("📝 История пуста.")
         return
 
-    lines = ["📝 <b>Последние операции:</b>"]
+    lines = [HISTORY_HEADER]
     for tx_type, amount, timestamp in history_rows:
-        title = "Пополнение" if tx_type == "deposit" else "Вывод"
-        emoji = "💰" if tx_type == "deposit" else "💸"
-        lines.append(f"{emoji} {title}: <code>{amount:,.2f}</code> ₽ — {timestamp}")
+        title, emoji = TX_META[tx_type]
+        lines.append(HISTORY_LINE_TEMPLATE.format_map({"emoji": emoji, "title": title, "amount": amount, "timestamp": timestamp}))
     await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
 
 async def export_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not EXCEL_PATH.exists():
-        await update.message.reply_text("❌ Файл еще не создан.")
-        return
-    with open(EXCEL_PATH, "rb") as file:
-        await update.message.reply_document(
-            document=file,
-            filename=EXCEL_PATH.name,
-            caption="📤 Выгрузка общей Excel-базы",
-        )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = Path(tmp_dir) / EXCEL_PATH.name
+        await ledger.build_export_async(out_path)
+        content = await asyncio.to_thread(out_path.read_bytes)
+    await update.message.reply_document(
+        document=content,
+        filename=EXCEL_PATH.name,
+        caption="📤 Выгрузка общей Excel-базы",
+    )
 
 
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -304,31 +541,40 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     if query.data == "reset_confirm":
-        ledger.reset_user(query.from_user.id)
+        await ledger.reset_user_async(query.from_user.id)
         await query.edit_message_text("✅ Данные удалены")
     else:
         await query.edit_message_text("❌ Отмена")
 
 
+async def _menu_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data["awaiting_amount"] = "deposit"
+    await update.message.reply_text("Введи сумму пополнения числом.", reply_markup=ReplyKeyboardRemove())
+
+
+async def _menu_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data["awaiting_amount"] = "withdraw"
+    await update.message.reply_text("Введи сумму вывода числом.", reply_markup=ReplyKeyboardRemove())
+
+
+MENU_DISPATCH: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]] = {
+    "💼 Баланс": balance,
+    "📊 Статистика": stats,
+    "📝 История": history,
+    "💰 Пополнение": _menu_deposit,
+    "💸 Вывод": _menu_withdraw,
+    "📤 Экспорт": export_file,
+    "🗑 Сброс": reset,
+}
+# Порядок ключей задает порядок альтернатив в MENU_RE: самые частые кнопки идут первыми.
+MENU_RE = re.compile("^(" + "|".join(map(re.escape, MENU_DISPATCH)) + ")$")
+
+
 async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = (update.message.text or "").strip()
-    if text == "💰 Пополнение":
-        context.user_data["awaiting_amount"] = "deposit"
-        await update.message.reply_text("Введи сумму пополнения числом.", reply_markup=ReplyKeyboardRemove())
-    elif text == "💸 Вывод":
-        context.user_data["awaiting_amount"] = "withdraw"
-        await update.message.reply_text("Введи сумму вывода числом.", reply_markup=ReplyKeyboardRemove())
-    elif text == "💼 Баланс":
-        await balance(update, context)
-    elif text == "📊 Статистика":
-        await stats(update, context)
-    elif text == "📝 История":
-        await history(update, context)
-    elif text == "📤 Экспорт":
-        await export_file(update, context)
-    elif text == "🗑 Сброс":
-        await reset(update, context)
-
+    handler = MENU_DISPATCH.get(text)
+    if handler:
+        await handler(update, context)
 
 
 async def amount_from_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -344,22 +590,29 @@ async def amount_from_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
 
     context.user_data.pop("awaiting_amount", None)
-    user_id = update.effective_user.id
-    ledger.add_transaction(user_id, mode, amount)
-    _, _, user_balance, _ = ledger.get_user_stats(user_id)
-    action = "Пополнение" if mode == "deposit" else "Вывод"
-    await update.message.reply_text(
-        f"✅ {action}: <code>{amount:,.2f}</code> ₽\n💼 Баланс: <code>{user_balance:,.2f}</code> ₽",
-        parse_mode="HTML",
-        reply_markup=MENU_KEYBOARD,
-    )
+    await _record_tx(update, mode, amount, reply_markup=MENU_KEYBOARD)
+
+
+async def _post_init(app: Application) -> None:
+    ledger.start_writer()
+
+
+async def _post_shutdown(app: Application) -> None:
+    await ledger.stop_writer()
 
 
 def main() -> None:
     if not BOT_TOKEN:
         raise RuntimeError("Set BOT_TOKEN env variable before run")
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("add", add_deposit))
@@ -370,11 +623,21 @@ def main() -> None:
     app.add_handler(CommandHandler("export", export_file))
     app.add_handler(CommandHandler("reset", reset))
     app.add_handler(CallbackQueryHandler(button_callback))
-    app.add_handler(MessageHandler(filters.Regex(r"^(💰 Пополнение|💸 Вывод|💼 Баланс|📊 Статистика|📝 История|📤 Экспорт|🗑 Сброс)$"), menu_router))
+    app.add_handler(MessageHandler(filters.Regex(MENU_RE), menu_router))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, amount_from_menu))
 
-    logger.info("Bot started")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        logger.info("Bot started (webhook on port %d)", PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        logger.info("Bot started")
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":